@@ -5,6 +5,7 @@ from amaranth.build import *
 from amaranth_boards.icebreaker_bitsy import *
 
 from amaranth.lib.cdc import ResetSynchronizer
+from amaranth.lib.fifo import SyncFIFO
 
 
 import no2amaranth
@@ -44,11 +45,13 @@ class LoopbackTest(Elaboratable):
 			o_LOCK                  = pll_locked,
 		)
 
-		por_count = Signal(8)
-		por_rst   = Signal()
+		por_count = Signal(8, reset=0xff)
+		por_rst   = Signal(reset=1)
 
-		m.d.comb += por_rst.eq(~por_count[-1])
-		m.d.por += por_count.eq(por_count + ~por_count[-1])
+		m.d.por += [
+			por_count.eq(Mux(por_count == 0, 0, por_count - 1)),
+			por_rst.eq(por_count != 0),
+		]
 
 		platform.add_clock_constraint(clk48, 48e6)
 		platform.add_clock_constraint(clk24, 24e6)
@@ -68,13 +71,21 @@ class LoopbackTest(Elaboratable):
 			# Request pads with no buffers
 		usb_pads = platform.request("usb", dir={'d_p':'-','d_n':'-','pullup':'-'})
 
-		m.submodules.muacm_core = muacm = no2amaranth.NitroMuAcmBuffered(usb_pads, fifo_depth=256, product="bitsy")
+		m.submodules.muacm_core = muacm = no2amaranth.NitroMuAcmBuffered(usb_pads, fifo_depth_in=256, fifo_depth_out=16, use_last=False, product="bitsy")
+
+		# Loopback through a small FIFO to keep the ready/valid paths registered
+		m.submodules.loop = loop = SyncFIFO(width=8, depth=2)
 
 		m.d.comb += [
-			muacm.in_data.eq(muacm.out_data),
+			loop.w_data.eq(muacm.out_data),
+			loop.w_en.eq(muacm.out_valid),
+			muacm.out_ready.eq(loop.w_rdy),
+
+			muacm.in_data.eq(loop.r_data),
 			muacm.in_last.eq(0),
-			muacm.in_valid.eq(muacm.out_valid),
-			muacm.out_ready.eq(muacm.in_ready),
+			muacm.in_valid.eq(loop.r_rdy),
+			loop.r_en.eq(muacm.in_ready),
+
 			muacm.in_flush_time.eq(1),
 			muacm.in_flush_now.eq(0),
 		]
@@ -7,20 +7,130 @@
 # SPDX-License-Identifier: CERN-OHL-P-2.0
 #
 
-import importlib
+import functools
+import importlib.util
 import os
-import pkg_resources
 import tempfile
 
+from importlib.resources import files
+
 from amaranth import *
 from amaranth.build import Platform
 from amaranth.lib.cdc import FFSynchronizer, PulseSynchronizer
-from amaranth.lib.fifo import SyncFIFOBuffered
+from amaranth.lib.fifo import AsyncFIFO, SyncFIFO, SyncFIFOBuffered
 
 
 __all__ = [ 'NitroMuAcmSync', 'NitroMuAcmAsync', 'NitroMuAcmBuffered' ]
 
 
+# Interface signals common to all the μACM wrappers
+_MUACM_LAYOUT = [
+	("in_data",        8),
+	("in_last",        1),
+	("in_valid",       1),
+	("in_ready",       1),
+	("in_flush_now",   1),
+	("in_flush_time",  1),
+
+	("out_data",       8),
+	("out_last",       1),
+	("out_valid",      1),
+	("out_ready",      1),
+
+	("bootloader_req", 1),
+]
+
+
+@functools.lru_cache(maxsize=None)
+def _load_customizer():
+	# Load the customizer as module (only once)
+	mod_spec = importlib.util.spec_from_file_location(
+		'no2amaranth.no2muacm_customize',
+		str(files('no2amaranth').joinpath('cores/no2muacm-bin/muacm_customize.py'))
+	)
+	no2muacm_customize = importlib.util.module_from_spec(mod_spec)
+	mod_spec.loader.exec_module(no2muacm_customize)
+
+	return no2muacm_customize
+
+
+@functools.lru_cache(maxsize=None)
+def _tmp_dir():
+	# Scratch directory for the patcher output (one per process)
+	return tempfile.TemporaryDirectory(prefix='no2amaranth-')
+
+
+@functools.lru_cache(maxsize=None)
+def _build_ip(vid, pid, vendor, product, serial, no_dfu_rt):
+	# No customization: use the shipped file as-is, no need for the patcher
+	if (vid, pid, vendor, product, serial) == (None,) * 5 and not no_dfu_rt:
+		return files('no2amaranth').joinpath('cores/no2muacm-bin/muacm.v').read_bytes()
+
+	# Load source
+	sf = _load_customizer().MuAcmPatcher()
+	sf.load(str(files('no2amaranth').joinpath('cores/no2muacm-bin/muacm.v')))
+
+	# Apply requested customization
+	if vid is not None:
+		sf.set_vid(vid)
+
+	if pid is not None:
+		sf.set_pid(pid)
+
+	if vendor is not None:
+		sf.set_vendor(vendor)
+
+	if product is not None:
+		sf.set_product(product)
+
+	if serial is not None:
+		sf.set_serial(serial)
+
+	if no_dfu_rt:
+		sf.disable_dfu_rt()
+
+	# Save to a unique scratch file (concurrent builds must not collide)
+	# and grab the result. Keep a reference to the scratch directory object
+	# while in use, so it can't be cleaned up under us.
+	tmp_dir = _tmp_dir()
+	fd, ip_file_name = tempfile.mkstemp(suffix='.v', dir=tmp_dir.name)
+	os.close(fd)
+
+	try:
+		sf.save(ip_file_name)
+
+		with open(ip_file_name, 'rb') as fh:
+			return fh.read()
+	finally:
+		os.unlink(ip_file_name)
+
+
+def _sync_fifo(width, depth):
+	# Small FIFOs end up in registers anyway, so use a first-word-fall-through
+	# one without the extra output stage. Larger ones need the synchronous read
+	# port of SyncFIFOBuffered to be mapped to block RAM.
+	if depth <= 4:
+		return SyncFIFO(width=width, depth=depth)
+	else:
+		return SyncFIFOBuffered(width=width, depth=depth)
+
+
+def _add_misc_xclk(m, iface, core):
+	# Clock crossing of the non-data signals between an interface in 'sync'
+	# and a core running in 'usb_48'
+	m.submodules += [
+		FFSynchronizer(iface.in_flush_now,  core.in_flush_now,  o_domain='usb_48'),
+		FFSynchronizer(iface.in_flush_time, core.in_flush_time, o_domain='usb_48'),
+	]
+
+	ps_boot = PulseSynchronizer("usb_48", "sync")
+	m.submodules += ps_boot
+	m.d.comb += [
+		ps_boot.i.eq(core.bootloader_req),
+		iface.bootloader_req.eq(ps_boot.o),
+	]
+
+
 
 class NitroMuAcmSync(Elaboratable):
 	"""Wrapper for the Nitro FPGA μACM Core
@@ -56,19 +166,8 @@ class NitroMuAcmSync(Elaboratable):
 
 	def __init__(self, pads, **kwargs):
 		# External signals
-		self.in_data        = Signal(8)
-		self.in_last        = Signal()
-		self.in_valid       = Signal()
-		self.in_ready       = Signal()
-		self.in_flush_now   = Signal()
-		self.in_flush_time  = Signal()
-
-		self.out_data       = Signal(8)
-		self.out_last       = Signal()
-		self.out_valid      = Signal()
-		self.out_ready      = Signal()
-
-		self.bootloader_req = Signal()
+		for name, width in _MUACM_LAYOUT:
+			setattr(self, name, Signal(width, name=name))
 
 		# Save pads
 		self.pads = pads
@@ -79,8 +178,10 @@ class NitroMuAcmSync(Elaboratable):
 	def elaborate(self, platform: Platform) -> Module:
 		m = Module()
 
-		# Add source content from temp file directly
-		platform.add_file('muacm.v', self.ip_file)
+		# Add source content directly. Identical IPs share the same file, and
+		# the platform rejects conflicting content (only one 'muacm' module
+		# can exist in a design)
+		platform.add_file('muacm.v', self.ip_data)
 
 		# And instance
 		m.submodules += Instance("muacm",
@@ -105,110 +206,17 @@ class NitroMuAcmSync(Elaboratable):
 		return m
 
 	def gen_customized_ip(self, **kwargs):
-		# Load the customizer as module
-		mod_spec = importlib.util.spec_from_file_location(
-			'no2amaranth.no2muacm_customize',
-			pkg_resources.resource_filename('no2amaranth', 'cores/no2muacm-bin/muacm_customize.py')
+		# Build (or fetch from cache) the customized IP
+		self.ip_data = _build_ip(
+			kwargs.get('vid'),
+			kwargs.get('pid'),
+			kwargs.get('vendor'),
+			kwargs.get('product'),
+			kwargs.get('serial'),
+			bool(kwargs.get('no_dfu_rt')),
 		)
-		no2muacm_customize = importlib.util.module_from_spec(mod_spec)
-		mod_spec.loader.exec_module(no2muacm_customize)
-
-		# Load source
-		sf = no2muacm_customize.MuAcmPatcher()
-		sf.load(pkg_resources.resource_filename('no2amaranth', 'cores/no2muacm-bin/muacm.v'))
-
-		# Apply requested customization
-		if kwargs.get('vid') is not None:
-			sf.set_vid(kwargs['vid'])
-
-		if kwargs.get('pid') is not None:
-			sf.set_pid(kwargs['pid'])
-
-		if kwargs.get('vendor') is not None:
-			sf.set_vendor(kwargs['vendor'])
-
-		if kwargs.get('product') is not None:
-			sf.set_product(kwargs['product'])
-
-		if kwargs.get('serial') is not None:
-			sf.set_serial(kwargs['serial'])
-
-		if bool(kwargs.get('no_dfu_rt')) is True:
-			sf.disable_dfu_rt()
-
-		# Save to temporary file
-		self.ip_file = tempfile.NamedTemporaryFile(suffix='.v')
-		ip_file_name = os.path.abspath(self.ip_file.name)
-		sf.save(ip_file_name)
-
-		return ip_file_name
-
-
-class NitroMuAcmXClk(Elaboratable):
-	"""Lightweight clock crossing for the data interface of NitroMuAcmSync
-
-	Use DomainRenamer to assign to the right domains.
 
-	Attributes
-	----------
-
-	in_data   : Signal(8), in
-	in_last   : Signal(), in
-	in_valid  : Signal(), in
-	in_ready  : Signal(), out
-	   AXI-Stream style data interface (ingress, 'in_' clock domain)
-
-	out_data  : Signal(8), out
-	out_last  : Signal(), out
-	out_valid : Signal(), out
-	out_ready : Signal(), in
-	   AXI-Stream style data interface (egress, 'out' clock domain)
-	"""
-
-	def __init__(self):
-		# External signals
-		self.in_data   = Signal(8)
-		self.in_last   = Signal()
-		self.in_valid  = Signal()
-		self.in_ready  = Signal()
-
-		self.out_data  = Signal(8)
-		self.out_last  = Signal()
-		self.out_valid = Signal()
-		self.out_ready = Signal()
-
-	def elaborate(self, platform: Platform) -> Module:
-		m = Module()
-
-		# Internal signals
-		send_in        = Signal()
-		send_sync_out  = Signal(2)
-
-		ack_out        = Signal()
-		ack_sync_in    = Signal(2)
-
-		# Data is straight across
-		m.d.comb += [
-			self.out_data.eq  (self.in_data),
-			self.out_last.eq  (self.in_last),
-		]
-
-		# Handshaking
-		m.d.in_ += [
-			send_in.eq( (send_in | (self.in_valid & ~self.in_ready) ) & ~ack_sync_in[0] ),
-			ack_sync_in[1].eq( ack_sync_in[0] ),
-			ack_sync_in[0].eq( ack_out ),
-			self.in_ready.eq( ack_sync_in[0] & ~ack_sync_in[1] ),
-		]
-
-		m.d.out += [
-			send_sync_out[1].eq( send_sync_out[0] ),
-			send_sync_out[0].eq( send_in ),
-			self.out_valid.eq( (self.out_valid & ~self.out_ready) | (send_sync_out[0] & ~send_sync_out[1]) ),
-			ack_out.eq( (ack_out & send_sync_out[0]) | (self.out_valid & self.out_ready) ),
-		]
-
-		return m
+		return self.ip_data
 
 
 class NitroMuAcmAsync(Elaboratable):
@@ -219,19 +227,8 @@ class NitroMuAcmAsync(Elaboratable):
 
 	def __init__(self, pads, **kwargs):
 		# External signals
-		self.in_data        = Signal(8)
-		self.in_last        = Signal()
-		self.in_valid       = Signal()
-		self.in_ready       = Signal()
-		self.in_flush_now   = Signal()
-		self.in_flush_time  = Signal()
-
-		self.out_data       = Signal(8)
-		self.out_last       = Signal()
-		self.out_valid      = Signal()
-		self.out_ready      = Signal()
-
-		self.bootloader_req = Signal()
+		for name, width in _MUACM_LAYOUT:
+			setattr(self, name, Signal(width, name=name))
 
 		# Create customized core
 		self.core = NitroMuAcmSync(pads, **kwargs)
@@ -241,44 +238,34 @@ class NitroMuAcmAsync(Elaboratable):
 
 		# Create cores
 		m.submodules.core = core = DomainRenamer('usb_48')(self.core)
-		m.submodules.xin  = xin  = DomainRenamer({"in_": "sync",   "out": "usb_48"})(NitroMuAcmXClk())
-		m.submodules.xout = xout = DomainRenamer({"in_": "usb_48", "out": "sync"  })(NitroMuAcmXClk())
+		m.submodules.xin  = xin  = AsyncFIFO(width=9, depth=4, w_domain='sync',   r_domain='usb_48')
+		m.submodules.xout = xout = AsyncFIFO(width=9, depth=4, w_domain='usb_48', r_domain='sync')
 
 		# Wire stuff up
 		m.d.comb += [
-			xin.in_data.eq(self.in_data),
-			xin.in_last.eq(self.in_last),
-			xin.in_valid.eq(self.in_valid),
-			self.in_ready.eq(xin.in_ready),
-
-			core.in_data.eq(xin.out_data),
-			core.in_last.eq(xin.out_last),
-			core.in_valid.eq(xin.out_valid),
-			xin.out_ready.eq(core.in_ready),
-
-			xout.in_data.eq(core.out_data),
-			xout.in_last.eq(core.out_last),
-			xout.in_valid.eq(core.out_valid),
-			core.out_ready.eq(xout.in_ready),
-
-			self.out_data.eq(xout.out_data),
-			self.out_last.eq(xout.out_last),
-			self.out_valid.eq(xout.out_valid),
-			xout.out_ready.eq(self.out_ready),
+			xin.w_data[0:8].eq(self.in_data),
+			xin.w_data[8].eq(self.in_last),
+			xin.w_en.eq(self.in_valid),
+			self.in_ready.eq(xin.w_rdy),
+
+			core.in_data.eq(xin.r_data[0:8]),
+			core.in_last.eq(xin.r_data[8]),
+			core.in_valid.eq(xin.r_rdy),
+			xin.r_en.eq(core.in_ready),
+
+			xout.w_data[0:8].eq(core.out_data),
+			xout.w_data[8].eq(core.out_last),
+			xout.w_en.eq(core.out_valid),
+			core.out_ready.eq(xout.w_rdy),
+
+			self.out_data.eq(xout.r_data[0:8]),
+			self.out_last.eq(xout.r_data[8]),
+			self.out_valid.eq(xout.r_rdy),
+			xout.r_en.eq(self.out_ready),
 		]
 
 		# X-clk for other signals
-		m.submodules += [
-			FFSynchronizer(self.in_flush_now,  core.in_flush_now),
-			FFSynchronizer(self.in_flush_time, core.in_flush_time),
-		]
-
-		ps_boot = PulseSynchronizer("usb_48", "sync")
-		m.submodules += ps_boot
-		m.d.comb += [
-			ps_boot.i.eq(core.bootloader_req),
-			self.bootloader_req.eq(ps_boot.o),
-		]
+		_add_misc_xclk(m, self, core)
 
 		return m
 
@@ -287,66 +274,100 @@ class NitroMuAcmBuffered(Elaboratable):
 	"""Same interface as NitroMuAcmSync but with small FIFOs added to improve
 	efficiency. Clocking scheme is either from NitroMuAcmSync (requiring 'sync'
 	clock to be 48 MHz), or NitroMuAcmAsync (requiring a 'usb_48' domain but
-	being flexibe on what the interface / 'sync' clock is)."""
-
-	def __init__(self, pads, sync=False, fifo_depth=4, **kwargs):
+	being flexibe on what the interface / 'sync' clock is). In the latter case
+	the FIFOs themselves are asynchronous and take care of the clock crossing.
+
+	FIFO depths can be set per direction with `fifo_depth_in` (FPGA to Host)
+	and `fifo_depth_out` (Host to FPGA), or both at once with `fifo_depth`
+	(which can't be combined with the per-direction ones). Default is 4.
+	The `fifo_depth` attribute holds the common depth, or None if the two
+	directions differ.
+	In async mode, depths are rounded up to the next power of 2 (AsyncFIFO
+	requirement), e.g. 5 becomes 8.
+
+	If `use_last` is False, the `in_last` / `out_last` signals are not carried
+	through the FIFOs (`in_last` is ignored and `out_last` is always 0), which
+	saves one bit of width in each FIFO."""
+
+	def __init__(self, pads, sync=False, fifo_depth=None, fifo_depth_in=None, fifo_depth_out=None, use_last=True, **kwargs):
 		# External signals
-		self.in_data        = Signal(8)
-		self.in_last        = Signal()
-		self.in_valid       = Signal()
-		self.in_ready       = Signal()
-		self.in_flush_now   = Signal()
-		self.in_flush_time  = Signal()
-
-		self.out_data       = Signal(8)
-		self.out_last       = Signal()
-		self.out_valid      = Signal()
-		self.out_ready      = Signal()
-
-		self.bootloader_req = Signal()
+		for name, width in _MUACM_LAYOUT:
+			setattr(self, name, Signal(width, name=name))
 
 		# Config
-		self.fifo_depth = fifo_depth
-
-		# Create cores
-		if sync:
-			self.core = NitroMuAcmSync(pads, **kwargs)
+		if fifo_depth is not None:
+			if (fifo_depth_in is not None) or (fifo_depth_out is not None):
+				raise ValueError("fifo_depth can't be combined with fifo_depth_in / fifo_depth_out")
+			fifo_depth_in  = fifo_depth
+			fifo_depth_out = fifo_depth
 		else:
-			self.core = NitroMuAcmAsync(pads, **kwargs)
+			fifo_depth_in  = 4 if fifo_depth_in  is None else fifo_depth_in
+			fifo_depth_out = 4 if fifo_depth_out is None else fifo_depth_out
+
+		self.sync           = sync
+		self.fifo_depth_in  = fifo_depth_in
+		self.fifo_depth_out = fifo_depth_out
+		self.fifo_depth     = fifo_depth_in if fifo_depth_in == fifo_depth_out else None
+		self.use_last       = use_last
+
+		# Create customized core
+		self.core = NitroMuAcmSync(pads, **kwargs)
 
 	def elaborate(self, platform: Platform) -> Module:
 		m = Module()
 
-		m.submodules.core     = core = self.core
-		m.submodules.fifo_in  = fin  = SyncFIFOBuffered(width=9, depth=self.fifo_depth)
-		m.submodules.fifo_out = fout = SyncFIFOBuffered(width=9, depth=self.fifo_depth)
+		# FIFOs are {last, data[7:0]} or just data[7:0]. No need to pad to the
+		# native BRAM width, on iCE40 a 9 bit wide memory already maps to a single
+		# SB_RAM40_4K (as 256x16) and the unused bits are simply left unconnected.
+		fifo_width = 9 if self.use_last else 8
+
+		if self.sync:
+			# Everything in 'sync'
+			m.submodules.core     = core = self.core
+			m.submodules.fifo_in  = fin  = _sync_fifo(width=fifo_width, depth=self.fifo_depth_in)
+			m.submodules.fifo_out = fout = _sync_fifo(width=fifo_width, depth=self.fifo_depth_out)
+
+			m.d.comb += [
+				core.in_flush_now.eq(self.in_flush_now),
+				core.in_flush_time.eq(self.in_flush_time),
+				self.bootloader_req.eq(core.bootloader_req),
+			]
+
+		else:
+			# Core in 'usb_48' and FIFOs doing the X-clk
+			m.submodules.core     = core = DomainRenamer('usb_48')(self.core)
+			m.submodules.fifo_in  = fin  = AsyncFIFO(width=fifo_width, depth=self.fifo_depth_in,  w_domain='sync',   r_domain='usb_48')
+			m.submodules.fifo_out = fout = AsyncFIFO(width=fifo_width, depth=self.fifo_depth_out, w_domain='usb_48', r_domain='sync')
+
+			# X-clk for other signals
+			_add_misc_xclk(m, self, core)
 
 		# Wire stuff up
 		m.d.comb += [
-			core.in_flush_now.eq(self.in_flush_now),
-			core.in_flush_time.eq(self.in_flush_time),
-			self.bootloader_req.eq(core.bootloader_req),
-
 			fin.w_data[0:8].eq(self.in_data),
-			fin.w_data[8].eq(self.in_last),
 			fin.w_en.eq(self.in_valid),
 			self.in_ready.eq(fin.w_rdy),
 
 			core.in_data.eq(fin.r_data[0:8]),
-			core.in_last.eq(fin.r_data[8]),
 			core.in_valid.eq(fin.r_rdy),
 			fin.r_en.eq(core.in_ready),
 
 			fout.w_data[0:8].eq(core.out_data),
-			fout.w_data[8].eq(core.out_last),
 			fout.w_en.eq(core.out_valid),
 			core.out_ready.eq(fout.w_rdy),
 
 			self.out_data.eq(fout.r_data[0:8]),
-			self.out_last.eq(fout.r_data[8]),
 			self.out_valid.eq(fout.r_rdy),
 			fout.r_en.eq(self.out_ready),
 		]
 
+		if self.use_last:
+			m.d.comb += [
+				fin.w_data[8].eq(self.in_last),
+				core.in_last.eq(fin.r_data[8]),
+				fout.w_data[8].eq(core.out_last),
+				self.out_last.eq(fout.r_data[8]),
+			]
+
 		return m
 